@@ -1,151 +1,336 @@
 import argparse
+import bisect
 import http.client
 import sys
-import re
-import itertools
 import json
+import os
 import random
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
+import urllib3
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import inch
 from reportlab.lib.pagesizes import LETTER
 
 from boardgamegeek import BoardGameGeek
+from boardgamegeek.exceptions import BoardGameGeekError
+from boardgamegeek.utils import get_parsed_xml_response, xml_subelement_attr
 
-bgg = BoardGameGeek()
+BGG_API_URL = "https://www.boardgamegeek.com/xmlapi2"
+# trade lines look like "(giver) ... receives (receiver) ..."
+RECEIVES = "receives ("
 
+LABELS_PER_PAGE = 10
+LABELS_PER_ROW = 2
+TOP_MARGIN = 0.5 * inch  # inch
+LEFT_MARGIN = 0.18 * inch  # 0.28125 / 2 * inch
+LABEL_WIDTH = 4 * inch  # 2.625 * inch
+LABEL_HEIGHT = 2 * inch  # 1 * inch
+# absolute centre of every label slot on a page, row by row
+LABEL_CENTRES = [
+    (
+        LEFT_MARGIN + col * (LABEL_WIDTH + LEFT_MARGIN) + LABEL_WIDTH / 2,
+        LETTER[1] - TOP_MARGIN - LABEL_HEIGHT / 2 - row * LABEL_HEIGHT,
+    )
+    for row in range(LABELS_PER_PAGE // LABELS_PER_ROW)
+    for col in range(LABELS_PER_ROW)
+]
+USERNAME_POSITIONS = [(x, y + LABEL_HEIGHT / 5) for x, y in LABEL_CENTRES]
+REAL_NAME_POSITIONS = [(x, y - LABEL_HEIGHT / 5) for x, y in LABEL_CENTRES]
+PAGE_HEADER_X = LETTER[0] / 2 - 50
+PAGE_HEADER_YS = (10, LETTER[1] - 25)
+USERNAME_MAX_LENGTH = 16
+REAL_NAME_MAX_LENGTH = 25
+# how long to trust a cached "not on BGG" before asking again
+NOT_FOUND_TTL = 30 * 24 * 60 * 60  # seconds
 
-def iter_batches(iterable, size):
-    sourceiter = iter(iterable)
-    try:
-        while True:
-            batchiter = itertools.islice(sourceiter, size)
-            yield itertools.chain([next(batchiter)], batchiter)
-    except StopIteration:
-        return
+# lookup_name() result for a lookup that failed (error page, timeout, connection
+# error), as opposed to None for a user BGG doesn't know
+LOOKUP_FAILED = object()
 
+# the label_* fields are pre-truncated to fit on a nametag
+Trader = namedtuple("Trader", "username real_name label_username label_real_name")
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("tradeid", type=int)
-    parser.add_argument("--no-labels", action="store_true")
-    parser.add_argument("--random-traders", type=int, default=0)
-    args = parser.parse_args()
-    url = f"http://bgg.activityclub.org/olwlg/{args.tradeid}-results-official.txt"
-    print(f"trade results url: {url}")
-    resp = requests.get(
-        url,
-        verify=False,
-    )
-    if resp.status_code != http.client.OK:
-        print(
-            f"could not access official results for {args.tradeid}: {resp.status_code}"
+session = requests.Session()
+# the results URL is plain http://, so this is a no-op for it today; it only
+# keeps the old verify=False behaviour should the host redirect to https
+session.verify = False
+
+bgg = BoardGameGeek()
+
+
+def lookup_name(username):
+    # a bare /user query skips the buddy/guild/hot/top lists (and their extra
+    # pages) that bgg.user() asks for; we only need the real name
+    try:
+        root = get_parsed_xml_response(
+            bgg.requests_session, f"{BGG_API_URL}/user", params={"name": username}
         )
-        sys.exit(1)
-    results = resp.text
+    except BoardGameGeekError:
+        # non-XML error pages, 503s or timeouts that outlast the retries and
+        # connection errors all end up here
+        return LOOKUP_FAILED
+    # unknown users come back with an empty id
+    if not root.attrib.get("id"):
+        return None
+    # either name may be missing or blank; avoid labels reading "None None"
+    first = xml_subelement_attr(root, "firstname") or ""
+    last = xml_subelement_attr(root, "lastname") or ""
+    return f"{first} {last}".strip()
 
-    cache_fname = "bgg_trade_cache_{}.json".format(args.tradeid)
+
+def load_cache(fname):
+    cache = {}
+    save_needed = False
     try:
-        with open(cache_fname) as f:
-            cache = json.load(f)
+        with open(fname) as f:
+            for line in f:
+                # a last line missing its newline would get the next append glued
+                # onto it, so rewrite the file even if the record itself parses
+                if not line.endswith("\n"):
+                    save_needed = True
+                try:
+                    t, n = json.loads(line)
+                except (ValueError, TypeError):
+                    # torn or malformed line, e.g. from an interrupted run; the
+                    # rewrite drops it
+                    save_needed = True
+                    continue
+                cache[t] = n
     except FileNotFoundError:
-        cache = {}
+        # older versions kept the cache as a single JSON object
+        try:
+            with open(os.path.splitext(fname)[0] + ".json") as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return cache
+        save_needed = True
+    if save_needed:
+        save_cache(cache, fname)
+    return cache
+
+
+def cache_line(t, n):
+    return json.dumps([t, n], separators=(",", ":")) + "\n"
+
+
+def cached_name(entry):
+    # users missing from BGG are cached as {"missing": True, "ts": <lookup time>}
+    return entry if isinstance(entry, str) else ""
+
+
+def needs_lookup(entry, now):
+    if entry is None:
+        return True
+    return isinstance(entry, dict) and now - entry["ts"] > NOT_FOUND_TTL
+
+
+def save_cache(cache, fname):
+    # serialize up front and hand the file a single write instead of one per entry
+    data = "".join(cache_line(t, n) for t, n in cache.items()).encode("utf-8")
+    # write to a temporary file first so an interrupted run can't truncate the cache
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "wb") as f:
+        f.write(data)
+    os.replace(tmp_fname, fname)
+
+
+def iter_batches(seq, size):
+    for start in range(0, len(seq), size):
+        yield seq[start : start + size]
+
+
+def parse_traders(lines):
+    # the line shape is fixed, so plain str.find() scanning does the job of a regex
     traders = set()
-    for line in results.split("\n"):
-        m = re.match(r"\((.*?)\).*receives \((.*?)\).*", line)
-        if m:
-            traders.add(m.group(1))
-            traders.add(m.group(2))
-    if args.random_traders > 0:
-        print(
-            f"randomly selected traders: {random.sample(traders, args.random_traders)}"
-        )
-    if args.no_labels:
-        sys.exit(0)
-    traders = sorted(traders)
-    for t in traders:
-        if t not in cache:
-            u = bgg.user(t)
-            if u:
-                print((t, u.firstname, u.lastname))
-                n = "{} {}".format(u.firstname, u.lastname)
+    for line in lines:
+        if not line.startswith("("):
+            continue
+        giver_end = line.find(")")
+        if giver_end < 0:
+            continue
+        receiver_start = line.find(RECEIVES, giver_end)
+        if receiver_start < 0:
+            continue
+        receiver_start += len(RECEIVES)
+        receiver_end = line.find(")", receiver_start)
+        if receiver_end < 0:
+            continue
+        traders.update((line[1:giver_end], line[receiver_start:receiver_end]))
+    return traders
+
+
+def lookup_missing(traders, cache, cache_fname, workers):
+    now = time.time()
+    missing = [t for t in traders if needs_lookup(cache.get(t), now)]
+    # boardgamegeek spaces request starts 2s apart (30/min), so a couple of
+    # workers only overlap one lookup's round trip with the next one's wait;
+    # results are merged here in the main thread and appended to the cache as
+    # they complete, so nothing is lost on interruption
+    ex = ThreadPoolExecutor(max_workers=workers)
+    futures = {ex.submit(lookup_name, t): t for t in missing}
+    try:
+        with open(cache_fname, "a") as cache_f:
+            for future in as_completed(futures):
+                t = futures[future]
+                n = future.result()
+                # a failed request says nothing about the user, leave them
+                # uncached so the next run asks again
+                if n is LOOKUP_FAILED:
+                    print(f"Warning: lookup of user {t} failed, not caching")
+                    continue
+                # users without a real name on BGG get "", which still counts
+                # as found
+                if n is not None:
+                    print((t, n))
+                else:
+                    print(f"Warning: user {t} not found on BGG")
+                    n = {"missing": True, "ts": time.time()}
                 cache[t] = n
-            else:
-                print(f"Warning: user {t} not found on BGG")
-            with open(cache_fname, "w") as f:
-                json.dump(cache, f)
-    traders = [(t, cache[t]) for t in traders]
-    print(f"{len(traders)} Traders found")
+                cache_f.write(cache_line(t, n))
+                cache_f.flush()
+    finally:
+        # on Ctrl-C drop the queued lookups instead of working through them
+        ex.shutdown(cancel_futures=True)
 
-    cutoffs = (len(traders) // 3, len(traders) * 2 // 3, len(traders))
-    print(f"cuttoffs: {cutoffs}")
-    for i in (0, 1):
-        while traders[cutoffs[i]][0][0] == traders[cutoffs[i] - 1][0][0]:
-            print(f"{traders[cutoffs[i]]}, {traders[cutoffs[i] - 1]}")
-            cutoffs = (
-                cutoffs[0] + (1 if i == 0 else 0),
-                cutoffs[1] + (1 if i == 1 else 0),
-                cutoffs[2],
+
+def calculate_cutoffs(first_letters):
+    n = len(first_letters)
+    cutoffs = []
+    start = 0
+    for third in (1, 2):
+        cutoff = max(n * third // 3, start)
+        # never split a letter: move past the run sharing the letter just before
+        if 0 < cutoff < n:
+            cutoff = bisect.bisect_right(
+                first_letters, first_letters[cutoff - 1], cutoff
             )
-    print(f"adjusted cuttoffs: {cutoffs}")
+        cutoffs.append(cutoff)
+        start = cutoff
+    cutoffs.append(n)
+    cutoffs = tuple(cutoffs)
+    print(f"cutoffs: {cutoffs}")
+    return cutoffs
 
-    # print("\n".join([str(t) for t in traders]))
-    c = canvas.Canvas("traders_{}.pdf".format(args.tradeid), pagesize=LETTER)
 
-    # first print some name lists
+def draw_namelists(c, traders, first_letters, cutoffs):
     i = 0
-    for ci, cutoff in enumerate(cutoffs):
-        c.saveState()
-        c.translate(LETTER[0] / 2, LETTER[1] - 50)
+    for cutoff in cutoffs:
+        # a letter run can swallow a whole section on small or skewed trades
+        if cutoff == i:
+            continue
+        # absolute coordinates, no graphics state to save or translate per line
+        centre = LETTER[0] / 2
+        y = LETTER[1] - 50
         c.setFont("Helvetica", 25)
-        c.drawCentredString(0, 0, f"{traders[i][0][0]}-{traders[cutoff - 1][0][0]}")
-        c.translate(0, -40)
+        c.drawCentredString(
+            centre, y, f"{first_letters[i]}-{first_letters[cutoff - 1]}".upper()
+        )
+        y -= 40
+        c.setFont("Helvetica", 12)
         while i < cutoff:
-            c.translate(0, -18)
-            c.rect(-130, 0, 10, 10, fill=0)
-            c.setFont("Helvetica", 12)
+            y -= 18
+            c.rect(centre - 130, y, 10, 10, fill=0)
             c.drawString(
-                -100,
-                0,
-                " ".join(traders[i]),
+                centre - 100,
+                y,
+                f"{traders[i].username} {traders[i].real_name}",
             )
             i += 1
         c.showPage()
 
-    LABELS_PER_PAGE = 10
-    LABELS_PER_ROW = 2
-    top_margin = 0.5 * inch  # inch
-    left_margin = 0.18 * inch  # 0.28125 / 2 * inch
-    label_width = 4 * inch  # 2.625 * inch
-    label_height = 2 * inch  # 1 * inch
+
+def draw_labels(c, traders, first_letters, cutoffs):
     i = 0
     for cutoff in cutoffs:
         for page_labels in iter_batches(traders[i:cutoff], LABELS_PER_PAGE):
-            page_labels = list(page_labels)
+            page_range = f"{first_letters[i]}-{first_letters[i + len(page_labels) - 1]}"
+            page_range = page_range.upper()
+            # draw at absolute positions, grouped by font so each page only
+            # switches fonts twice: headers and real names share 20pt
             c.setFont("Helvetica", 20)
-            c.drawCentredString(
-                LETTER[0] / 2 - 50,
-                10,
-                f"{page_labels[0][0][0]}-{page_labels[-1][0][0]}",
-            )
-            c.drawCentredString(
-                LETTER[0] / 2 - 50,
-                LETTER[1] - 25,
-                f"{page_labels[0][0][0]}-{page_labels[-1][0][0]}",
-            )
-            c.translate(0, LETTER[1] - top_margin - label_height / 2)
-            for labels in iter_batches(page_labels, LABELS_PER_ROW):
-                c.saveState()
-                c.translate(left_margin, 0)
-                for uname, name in labels:
-                    c.setFont("Helvetica", 25)
-                    c.drawCentredString((label_width / 2), label_height / 5, uname[:16])
-                    c.setFont("Helvetica", 20)
-                    c.drawCentredString((label_width / 2), -label_height / 5, name[:25])
-                    c.translate(label_width + left_margin, 0)
-                    i += 1
-                c.restoreState()
-                c.translate(0, -label_height)
+            for y in PAGE_HEADER_YS:
+                c.drawCentredString(PAGE_HEADER_X, y, page_range)
+            for (x, y), t in zip(REAL_NAME_POSITIONS, page_labels):
+                c.drawCentredString(x, y, t.label_real_name)
+            c.setFont("Helvetica", 25)
+            for (x, y), t in zip(USERNAME_POSITIONS, page_labels):
+                c.drawCentredString(x, y, t.label_username)
+            i += len(page_labels)
             c.showPage()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("tradeid", type=int)
+    parser.add_argument("--no-labels", action="store_true")
+    parser.add_argument("--random-traders", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument(
+        "--skip-lookup",
+        action="store_true",
+        help="only use names already in the cache, don't query BGG",
+    )
+    args = parser.parse_args()
+    # silenced only when run as a script, importers keep their own warnings
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    url = f"http://bgg.activityclub.org/olwlg/{args.tradeid}-results-official.txt"
+    print(f"trade results url: {url}")
+    # parse lines as they arrive rather than holding the body and a list of its lines
+    with session.get(url, stream=True, timeout=30) as resp:
+        if resp.status_code != http.client.OK:
+            print(
+                f"could not access official results for {args.tradeid}: {resp.status_code}"
+            )
+            sys.exit(1)
+        # without a text Content-Type requests has no encoding and iter_lines()
+        # would yield bytes; guess it like resp.text does (reads the body first)
+        resp.encoding = resp.encoding or resp.apparent_encoding or "utf-8"
+        # split on "\n" only: the default str.splitlines() also breaks on \x85,
+        # \x0b, \u2028 etc., which show up in UTF-8 titles decoded as ISO-8859-1
+        lines = resp.iter_lines(decode_unicode=True, delimiter="\n")
+        traders = parse_traders(line.rstrip("\r") for line in lines)
+
+    # sort before sampling, random.sample() no longer accepts sets; ignore case so
+    # "alice" and "Alice" end up in the same letter section, with the name itself
+    # as tie-break so their order doesn't depend on set iteration order
+    traders = sorted(traders, key=lambda t: (t.lower(), t))
+    if args.random_traders > 0:
+        print(
+            f"randomly selected traders: {random.sample(traders, args.random_traders)}"
+        )
+    # the sample only needs usernames, so don't touch the cache or BGG for it
+    if args.no_labels:
+        sys.exit(0)
+    cache_fname = "bgg_trade_cache_{}.jsonl".format(args.tradeid)
+    cache = load_cache(cache_fname)
+    if not args.skip_lookup:
+        lookup_missing(traders, cache, cache_fname, args.workers)
+    # truncate to what fits on a label once here, not every time a label is drawn
+    names = [cached_name(cache.get(t)) for t in traders]
+    traders = [
+        Trader(t, n, t[:USERNAME_MAX_LENGTH], n[:REAL_NAME_MAX_LENGTH])
+        for t, n in zip(traders, names)
+    ]
+    print(f"{len(traders)} Traders found")
+
+    # extracted once for cutoffs and range headers, lower-cased to match the sort
+    # order (the headers upper-case them for display)
+    first_letters = [t.username[:1].lower() for t in traders]
+    cutoffs = calculate_cutoffs(first_letters)
+
+    # print("\n".join([str(t) for t in traders]))
+    c = canvas.Canvas(
+        "traders_{}.pdf".format(args.tradeid), pagesize=LETTER, pageCompression=1
+    )
+    # first print some name lists
+    draw_namelists(c, traders, first_letters, cutoffs)
+    draw_labels(c, traders, first_letters, cutoffs)
     c.save()
+
+
+if __name__ == "__main__":
+    main()